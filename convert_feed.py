@@ -7,15 +7,24 @@ Output: feed.xml  (host this file publicly, e.g. via GitHub Pages)
 """
 
 import hashlib
+import io
+import json
 import os
 import sys
-import urllib.request
 import urllib.error
+import urllib.request
 import xml.etree.ElementTree as ET
+from pathlib import Path
 
 PODBEAN_FEED_URL = "https://feed.podbean.com/enachmanson/feed.xml"
 OUTPUT_FILE      = "feed.xml"
 HASH_FILE        = "last_hash.txt"
+HEADERS_FILE     = "headers_cache.json"
+PUBDATE_FILE     = "last_pubdate.txt"
+FEED_HASH_FILE   = "feed.sha1"
+EPISODES_FILE    = "episodes.json"
+FEED_SIG_FILE    = "feed.xml.sig"
+WRITE_BUFFER     = 1 << 20   # 1 MiB — feed.xml goes out in a single write() syscall
 
 # ── Spotify-specific fields to add/ensure ──────────────────────────────────
 SPOTIFY_EMAIL = ""          # Optional: add your email if the platform requires it
@@ -33,13 +42,69 @@ NAMESPACES = {
     "media":      "http://search.yahoo.com/mrss/",
 }
 
+# Registered once at import so every parse/serialize keeps the original prefixes
+for _prefix, _uri in NAMESPACES.items():
+    ET.register_namespace(_prefix, _uri)
+
+# Fixed prefix of every feed.xml; ElementTree's own declaration would use single quotes
+XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+
+# Clark-notation {uri}tag names, built once instead of per call / per item
+SPOTIFY_PREFIX    = f"{{{NAMESPACES['spotify']}}}"
+SPOTIFY_EMAIL_TAG = SPOTIFY_PREFIX + "email"
+SPOTIFY_LIMIT_TAG = SPOTIFY_PREFIX + "limit"
+SPOTIFY_COO_TAG   = SPOTIFY_PREFIX + "countryOfOrigin"
+SPOTIFY_ORDER_TAG = SPOTIFY_PREFIX + "order"
+
+# Channel-level Spotify tags and their values; empty values are skipped
+SPOTIFY_CHANNEL_TAGS = (
+    (SPOTIFY_EMAIL_TAG, SPOTIFY_EMAIL),
+    (SPOTIFY_LIMIT_TAG, str(SPOTIFY_LIMIT)),
+    (SPOTIFY_COO_TAG,   "il"),
+)
+
+# One opener for every fetch; build_opener() keeps urllib's proxy (HTTP(S)_PROXY) and redirect handling
+OPENER = urllib.request.build_opener()
+
+# Channel children that change with every episode and don't count as channel metadata
+CHANNEL_DATE_TAGS = ("pubDate", "lastBuildDate")
+
+
+def load_headers_cache() -> dict:
+    """Load the ETag / Last-Modified validators saved by the previous fetch."""
+    try:
+        with open(HEADERS_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_headers_cache(etag: str, last_modified: str):
+    write_file(HEADERS_FILE, json.dumps({"etag": etag, "last_modified": last_modified}, indent=2) + "\n")
+
+
+def fetch_feed(url: str, update_cache: bool = True, conditional: bool = True) -> tuple:
+    """
+    Fetch the feed with a conditional GET, asking for an RFC 3229 delta when possible.
+    Returns (status, body) with the body as undecoded bytes: 200 with the full feed,
+    226 with a delta feed holding only new/changed items, or 304 with no body.
+    With update_cache=False the response validators are not saved (used by check_feed.py);
+    with conditional=False no validators are sent, so the answer is always the full feed.
+    """
+    cache   = load_headers_cache() if conditional else {}
+    headers = {"User-Agent": "Mozilla/5.0"}
+    if cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+        headers["A-IM"] = "feed"
+    if cache.get("last_modified"):
+        headers["If-Modified-Since"] = cache["last_modified"]
 
-def fetch_feed(url: str) -> str:
     try:
-        req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            return resp.read().decode("utf-8")
+        with OPENER.open(urllib.request.Request(url, headers=headers), timeout=30) as resp:
+            raw = resp.read()  # kept as bytes: the XML parser and hashes consume bytes directly
     except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, None
         print(f"❌ HTTP error fetching feed: {e.code} {e.reason}")
         sys.exit(1)
     except urllib.error.URLError as e:
@@ -49,9 +114,18 @@ def fetch_feed(url: str) -> str:
         print(f"❌ Unexpected error fetching feed: {e}")
         sys.exit(1)
 
+    # Any 2xx gets here (urllib raises HTTPError for everything else), 226 included
+    if resp.status == 226 and "feed" not in [im.strip() for im in resp.headers.get("IM", "").split(",")]:
+        # Not a feed delta we asked for — don't merge an unknown instance manipulation
+        print("⚠️ HTTP 226 without 'IM: feed' — fetching the full feed instead ...")
+        return fetch_feed(url, update_cache, conditional=False)
+    if update_cache:
+        save_headers_cache(resp.headers.get("ETag", ""), resp.headers.get("Last-Modified", ""))
+    return resp.status, raw
+
 
-def compute_hash(text: str) -> str:
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+def compute_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
 
 
 def set_or_update(parent: ET.Element, tag: str, value: str):
@@ -63,42 +137,187 @@ def set_or_update(parent: ET.Element, tag: str, value: str):
         ET.SubElement(parent, tag).text = value
 
 
-def convert(raw_xml: str) -> str:
-    for prefix, uri in NAMESPACES.items():
-        ET.register_namespace(prefix, uri)
+def convert(raw_xml: bytes) -> bytes:
+    return convert_root(ET.fromstring(raw_xml))
+
+
+def convert_root(root: ET.Element) -> bytes:
+    """Add the Spotify tags to an already-parsed feed (in place) and serialize it."""
+    ensure_channel_spotify_tags(root)
+    assign_order(root.find("channel").iterfind("item"))
+    return serialize(root)
+
 
-    root = ET.fromstring(raw_xml)
-    spotify_ns_attrs = {f"xmlns:{k}": v for k, v in NAMESPACES.items()}
-    spotify_ns = NAMESPACES["spotify"]
+def ensure_channel_spotify_tags(root: ET.Element):
+    """Add or update the channel-level Spotify tags."""
     channel = root.find("channel")
 
-    if SPOTIFY_EMAIL:
-        set_or_update(channel, f"{{{spotify_ns}}}email", SPOTIFY_EMAIL)
+    # One pass over the channel's children instead of a find() per Spotify tag
+    present = {}
+    for child in channel:
+        if child.tag.startswith(SPOTIFY_PREFIX):
+            present.setdefault(child.tag, child)
+    for tag, value in SPOTIFY_CHANNEL_TAGS:
+        if not value:
+            continue
+        elem = present.get(tag)
+        if elem is None:
+            elem = ET.SubElement(channel, tag)
+        elem.text = value
+
+
+def assign_order(items):
+    """Number the given <item>s with spotify:order, newest first."""
+    # Hot loop over every episode: keep the SubElement lookup local
+    SubElement = ET.SubElement
+    for i, item in enumerate(items, start=1):
+        order = item.find(SPOTIFY_ORDER_TAG)
+        if order is None:
+            order = SubElement(item, SPOTIFY_ORDER_TAG)
+        order.text = str(i)
+
+
+def serialize(root: ET.Element) -> bytes:
+    """
+    Serialize straight to UTF-8 bytes behind the XML declaration, with no str round-trip.
+    ElementTree declares every namespace in use on <rss> itself (prefixes registered above).
+    """
+    buf = io.BytesIO()
+    buf.write(XML_DECLARATION)
+    ET.ElementTree(root).write(buf, encoding="utf-8", xml_declaration=False)
+    return buf.getvalue()
+
+
+def channel_signature(channel: ET.Element) -> str:
+    """
+    Hash of the channel-level metadata (title, image, description, ...), ignoring
+    episodes, pubDate/lastBuildDate and the Spotify tags we add ourselves.
+    """
+    h = hashlib.sha1()
+    for child in channel:
+        if child.tag == "item" or child.tag in CHANNEL_DATE_TAGS or child.tag.startswith(SPOTIFY_PREFIX):
+            continue
+        h.update(ET.tostring(child))
+    return h.hexdigest()
+
+
+def peek_channel_pubdate(raw_xml: bytes) -> str:
+    """Stream the feed only as far as channel/pubDate, without building the item tree."""
+    path = []
+    for event, elem in ET.iterparse(io.BytesIO(raw_xml), events=("start", "end")):
+        if event == "start":
+            path.append(elem.tag)
+            continue
+        path.pop()
+        if elem.tag == "pubDate" and path[-1:] == ["channel"]:
+            return elem.text or ""
+        elem.clear()
+    return ""
+
+
+def merge_delta(delta_xml: bytes) -> bytes:
+    """
+    Merge a delta feed (HTTP 226) into the existing feed.xml, keyed by <guid>.
+    Delta items for known GUIDs replace the existing item in its current position;
+    only GUIDs not seen before go to the top, in delta order. Channel metadata comes
+    from the delta. Returns None if there is no readable feed.xml to merge into.
+    """
+    delta_root  = ET.fromstring(delta_xml)
+    channel     = delta_root.find("channel")
+    delta_items = channel.findall("item")
+    delta_guids = [item.findtext("guid", "") for item in delta_items]
 
-    set_or_update(channel, f"{{{spotify_ns}}}limit", str(SPOTIFY_LIMIT))
-    set_or_update(channel, f"{{{spotify_ns}}}countryOfOrigin", "il")
+    try:
+        existing_root = ET.parse(OUTPUT_FILE).getroot()
+    except (FileNotFoundError, ET.ParseError):
+        return None  # nothing to merge into — the delta alone is not a complete feed
+
+    # Only non-empty GUIDs are matched; each delta item replaces at most one existing item
+    existing_items = existing_root.find("channel").findall("item")
+    known  = {item.findtext("guid", "") for item in existing_items} - {""}
+    merged = [item for item, guid in zip(delta_items, delta_guids) if guid not in known]
+    delta_by_guid = {guid: item for item, guid in zip(delta_items, delta_guids) if guid in known}
+    for item in existing_items:
+        merged.append(delta_by_guid.pop(item.findtext("guid", ""), item))
+
+    insert_at = list(channel).index(delta_items[0]) if delta_items else len(channel)
+    for item in delta_items:
+        channel.remove(item)
+    channel[insert_at:insert_at] = merged
+    return ET.tostring(delta_root, encoding="utf-8")
+
+
+def extract_episodes(root: ET.Element) -> tuple:
+    """
+    Extract episode GUIDs, titles, pubDates and links from a parsed XML tree
+    as four parallel lists (guids, titles, pubdates, links).
+    """
+    items = root.find("channel").findall("item")
+    return (
+        [item.findtext("guid", "")    for item in items],
+        [item.findtext("title", "")   for item in items],
+        [item.findtext("pubDate", "") for item in items],
+        [item.findtext("link", "")    for item in items],
+    )
+
+
+def episodes_by_guid(episodes: tuple) -> dict:
+    """Map each GUID to its (title, pubDate, link) tuple."""
+    guids, titles, pubdates, links = episodes
+    return dict(zip(guids, zip(titles, pubdates, links)))
+
+
+def load_existing_episodes() -> dict:
+    """
+    Episodes from the last written feed as {guid: (title, pubDate, link)}. Read from the
+    episodes.json cache when possible; fall back to parsing feed.xml if it is missing or corrupt.
+    """
+    try:
+        with open(EPISODES_FILE, encoding="utf-8") as f:
+            return {guid: (title, pubdate, link) for guid, (title, pubdate, link) in json.load(f).items()}
+    except (FileNotFoundError, json.JSONDecodeError, AttributeError, TypeError, ValueError):
+        pass
 
-    for i, item in enumerate(channel.findall("item"), start=1):
-        set_or_update(item, f"{{{spotify_ns}}}order", str(i))
+    if os.path.exists(OUTPUT_FILE):
+        try:
+            return episodes_by_guid(extract_episodes(ET.parse(OUTPUT_FILE).getroot()))
+        except ET.ParseError:
+            pass  # treat corrupt/missing file as empty
+    return {}
 
-    output = '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(root, encoding="unicode")
-    ns_block = " ".join(f'{k}="{v}"' for k, v in spotify_ns_attrs.items())
-    output = output.replace('<rss version="2.0"', f'<rss version="2.0"\n     {ns_block}')
-    return output
 
+def compute_episodes_hash(channel: ET.Element) -> str:
+    """
+    SHA-1 over the channel metadata signature and every <item>'s full XML (enclosure,
+    description, transcript, ...), so "nothing changed" is a single string comparison.
+    """
+    h = hashlib.sha1(channel_signature(channel).encode())
+    for item in channel.iterfind("item"):
+        h.update(ET.tostring(item))
+    return h.hexdigest()
 
-def extract_episodes(root: ET.Element) -> list:
-    """Extract episode GUIDs, titles and pubDates from a parsed XML tree."""
-    channel = root.find("channel")
-    return [
-        {
-            "guid":    item.findtext("guid", ""),
-            "title":   item.findtext("title", ""),
-            "pubDate": item.findtext("pubDate", ""),
-            "link":    item.findtext("link", ""),
-        }
-        for item in channel.findall("item")
-    ]
+
+def read_state(path: str) -> str:
+    """Contents of a small state file (hash, pubDate, ...), or "" if it doesn't exist yet."""
+    try:
+        return Path(path).read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return ""
+
+
+def write_file(path: str, data, buffering: int = -1):
+    """
+    Write data atomically: fill a .tmp sibling, then os.replace() it over path.
+    bytes are written as-is; str is encoded as UTF-8.
+    """
+    tmp = path + ".tmp"
+    if isinstance(data, bytes):
+        f = open(tmp, "wb", buffering=buffering)
+    else:
+        f = open(tmp, "w", encoding="utf-8", buffering=buffering)
+    with f:
+        f.write(data)
+    os.replace(tmp, path)
 
 
 def write_output(key: str, value: str):
@@ -115,35 +334,91 @@ def write_summary(text: str):
             f.write(text)
 
 
-def main():
-    print(f"Fetching {PODBEAN_FEED_URL} ...")
-    raw = fetch_feed(PODBEAN_FEED_URL)
-    new_root = ET.fromstring(raw)
+def skip_feed_update(reason: str, raw_hash: str, channel_pubdate: str, episodes_hash: str):
+    """
+    Early exit when feed.xml doesn't need rewriting. The raw feed still changed, so
+    record its hash, pubDate and episode hash (headers_cache.json was already saved by
+    fetch_feed) and ask the workflow to commit that state; otherwise check_feed.py would
+    keep reporting a change and the next run would redo the same work.
+    """
+    print(f"✅ {reason} — skipping update.")
+    write_file(HASH_FILE, raw_hash)
+    write_file(PUBDATE_FILE, channel_pubdate)
+    write_file(FEED_HASH_FILE, episodes_hash)
+    write_file("commit_msg.txt", f"Update feed state\n\n{reason}; feed.xml left as is.")
+    write_output("feed_updated", "false")
+    write_output("state_updated", "true")
 
-    # Load and parse existing feed.xml for comparison
-    existing_episodes = []
-    if os.path.exists(OUTPUT_FILE):
-        try:
-            existing_episodes = extract_episodes(ET.parse(OUTPUT_FILE).getroot())
-        except ET.ParseError:
-            pass  # treat corrupt/missing file as empty
-
-    new_episodes     = extract_episodes(new_root)
-    existing_by_guid = {ep["guid"]: ep for ep in existing_episodes}
-    new_by_guid      = {ep["guid"]: ep for ep in new_episodes}
 
-    new_found = [ep for ep in new_episodes if ep["guid"] not in existing_by_guid]
-    updated   = [
-        ep for ep in new_episodes
-        if ep["guid"] in existing_by_guid and ep != existing_by_guid[ep["guid"]]
-    ]
-    removed   = [ep for ep in existing_episodes if ep["guid"] not in new_by_guid]
-
-    total = len(new_episodes)
+def main():
+    print(f"Fetching {PODBEAN_FEED_URL} ...")
+    status, raw = fetch_feed(PODBEAN_FEED_URL)
+    if status == 304:
+        print("✅ Feed not modified (HTTP 304) — nothing to do.")
+        write_output("feed_updated", "false")
+        return
+    # Hash the body exactly as the server sent it, so it matches what check_feed.py computes
+    raw_hash = compute_hash(raw)
+    if status == 226:
+        print("Received delta feed (HTTP 226) — merging into existing feed ...")
+        merged = merge_delta(raw)
+        if merged is None:
+            print("⚠️ No readable feed.xml to merge into — fetching the full feed ...")
+            status, raw = fetch_feed(PODBEAN_FEED_URL, conditional=False)
+            raw_hash    = compute_hash(raw)
+        else:
+            raw = merged
+
+    # Cheap early exit: same channel pubDate and same raw body as the last feed.xml was built from.
+    # The pubDate alone doesn't move on removals or retitles, so it is never trusted on its own.
+    channel_pubdate = peek_channel_pubdate(raw)
+    saved_pubdate   = read_state(PUBDATE_FILE)
+    if channel_pubdate and channel_pubdate == saved_pubdate and raw_hash == read_state(HASH_FILE):
+        print(f"✅ Channel pubDate and feed hash unchanged ({channel_pubdate}) — skipping update.")
+        write_output("feed_updated", "false")
+        return
+
+    new_root     = ET.fromstring(raw)
+    new_episodes = extract_episodes(new_root)
+
+    # Compare a single hash of all episodes before diffing them one by one
+    episodes_hash = compute_episodes_hash(new_root.find("channel"))
+    saved_hash    = read_state(FEED_HASH_FILE)
+    if episodes_hash == saved_hash:
+        skip_feed_update("Episode list unchanged", raw_hash, channel_pubdate, episodes_hash)
+        return
+
+    # Load existing episodes (cached, or parsed from feed.xml) for comparison
+    existing_by_guid = load_existing_episodes()
+    new_by_guid      = episodes_by_guid(new_episodes)
+    new_guids, titles, pubdates, links = new_episodes
+
+    # Lists of (guid, (title, pubDate, link)) pairs, walked in feed order so duplicate GUIDs
+    # each count; the field tuples are compared in one go.
+    # One pass and one dict lookup per episode for both new and updated.
+    new_found = []
+    updated   = []
+    for guid, fields in zip(new_guids, zip(titles, pubdates, links)):
+        prev = existing_by_guid.get(guid)
+        if prev is None:
+            new_found.append((guid, fields))
+        elif prev != fields:
+            updated.append((guid, fields))
+    removed   = [guid for guid in existing_by_guid if guid not in new_by_guid]
+
+    total = len(new_guids)
+
+    # Convert the already-parsed tree (no second parse of the raw XML)
+    output       = convert_root(new_root)
+    feed_digest  = hashlib.blake2b(output, digest_size=16).hexdigest()
+    saved_digest = read_state(FEED_SIG_FILE)
+    if feed_digest == saved_digest:
+        skip_feed_update("Converted feed is identical to feed.xml", raw_hash, channel_pubdate, episodes_hash)
+        return
 
     # ── Build commit title ──
     if len(new_found) == 1 and not updated and not removed:
-        commit_title = f"New episode: {new_found[0]['title']}"
+        commit_title = f"New episode: {new_found[0][1][0]}"
     else:
         parts = []
         if new_found:
@@ -163,23 +438,24 @@ def main():
         lines.append("The raw feed XML changed (e.g. metadata, transcript tags).")
     if new_found:
         lines.append("New episodes:")
-        for ep in new_found:
-            lines.append(f"  + {ep['title']} ({ep['pubDate']})")
-            if ep["link"]:
-                lines.append(f"    {ep['link']}")
+        for _, (title, pubdate, link) in new_found:
+            lines.append(f"  + {title} ({pubdate})")
+            if link:
+                lines.append(f"    {link}")
     if updated:
         lines.append("Updated episodes:")
-        for ep in updated:
-            old_ep = existing_by_guid[ep["guid"]]
-            lines.append(f"  ~ {ep['title']} ({ep['pubDate']})")
-            if old_ep["title"] != ep["title"]:
-                lines.append(f"      title:   {old_ep['title']} → {ep['title']}")
-            if old_ep["pubDate"] != ep["pubDate"]:
-                lines.append(f"      pubDate: {old_ep['pubDate']} → {ep['pubDate']}")
+        for guid, (title, pubdate, _) in updated:
+            old_title, old_pubdate, _ = existing_by_guid[guid]
+            lines.append(f"  ~ {title} ({pubdate})")
+            if old_title != title:
+                lines.append(f"      title:   {old_title} → {title}")
+            if old_pubdate != pubdate:
+                lines.append(f"      pubDate: {old_pubdate} → {pubdate}")
     if removed:
         lines.append("Removed episodes:")
-        for ep in removed:
-            lines.append(f"  - {ep['title']} ({ep['pubDate']})")
+        for guid in removed:
+            title, pubdate, _ = existing_by_guid[guid]
+            lines.append(f"  - {title} ({pubdate})")
 
     commit_body = "\n".join(lines)
 
@@ -187,25 +463,28 @@ def main():
     print(commit_body)
 
     # Write commit message for the workflow
-    with open("commit_msg.txt", "w", encoding="utf-8") as f:
-        f.write(commit_title + "\n\n" + commit_body)
+    write_file("commit_msg.txt", commit_title + "\n\n" + commit_body)
 
-    # Signal whether actual episodes changed (vs metadata-only)
+    # Signal whether feed.xml was rewritten, and whether actual episodes changed (vs metadata-only)
+    write_output("feed_updated", "true")
     write_output("episode_changed", "true" if (new_found or removed) else "false")
 
     # Write GitHub Actions job summary
-    summary_lines = [f"### 📻 {commit_title} ({total} episodes total)\n\n"]
-    for line in lines:
-        summary_lines.append(line + "  \n")
-    write_summary("".join(summary_lines))
+    summary_text = f"### 📻 {commit_title} ({total} episodes total)\n\n" + "".join(
+        f"{line}  \n" for line in lines
+    )
+    write_summary(summary_text)
 
     # Write updated feed
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        f.write(convert(raw))
-
-    # Write updated hash so it gets committed alongside feed.xml
-    with open(HASH_FILE, "w", encoding="utf-8") as f:
-        f.write(compute_hash(raw))
+    write_file(OUTPUT_FILE, output, buffering=WRITE_BUFFER)
+
+    # Write updated hashes, digest, pubDate and episode cache so they get committed alongside feed.xml
+    write_file(HASH_FILE, raw_hash)
+    write_file(PUBDATE_FILE, channel_pubdate)
+    write_file(FEED_HASH_FILE, episodes_hash)
+    write_file(FEED_SIG_FILE, feed_digest)
+    write_file(EPISODES_FILE, json.dumps(new_by_guid, ensure_ascii=False, indent=1) + "\n",
+               buffering=WRITE_BUFFER)
 
     print(f"✅ Feed updated: {OUTPUT_FILE}")
 